@@ -6,21 +6,31 @@
 import os
 import io
 import sys
+import subprocess
+import tempfile
+import threading
+import time
 import unittest
-from kvstore import KeyValueStore, _parse_command, KVError, DATA_FILE
+import kvstore
+from kvstore import KeyValueStore, _parse_command, KVError, DATA_FILE, SNAP_FILE
+
+
+def _remove_store_files() -> None:
+    for path in (DATA_FILE, SNAP_FILE):
+        if os.path.exists(path):
+            os.remove(path)
 
 
 class TestKeyValueStore(unittest.TestCase):
 
     def setUp(self) -> None:
-        """Remove existing data file before each test for isolation."""
-        if os.path.exists(DATA_FILE):
-            os.remove(DATA_FILE)
+        """Remove existing data files before each test for isolation."""
+        _remove_store_files()
         self.store = KeyValueStore()
 
     def tearDown(self) -> None:
-        if os.path.exists(DATA_FILE):
-            os.remove(DATA_FILE)
+        self.store.close()
+        _remove_store_files()
 
     def test_set_and_get_basic(self) -> None:
         self.store.set("name", "Badrinath")
@@ -49,6 +59,20 @@ class TestKeyValueStore(unittest.TestCase):
         self.store.set("key", "")
         self.assertEqual(self.store.get("key"), "")
 
+    def test_empty_key_and_value_survive_restart(self) -> None:
+        self.store.set("", "emptykey")
+        self.store.set("key", "")
+        new_store = KeyValueStore()
+        self.assertEqual(new_store.get(""), "emptykey")
+        self.assertEqual(new_store.get("key"), "")
+
+    def test_set_rejects_unframeable_pairs(self) -> None:
+        for key, value in [("a b", "v"), ("a\nb", "v"), ("k", "v\nSET x y"),
+                           ("k", "v\r"), ("a\udc80", "v"), ("k", "a\udc80")]:
+            with self.assertRaises(KVError):
+                self.store.set(key, value)
+        self.assertEqual(self.store.index, {})
+
     def test_unicode_support(self) -> None:
         self.store.set("emoji", "")
         self.assertEqual(self.store.get("emoji"), "")
@@ -65,6 +89,289 @@ class TestKeyValueStore(unittest.TestCase):
         self.assertEqual(self.store.get("a"), "1")
         self.assertEqual(self.store.get("b"), "2")
 
+    def test_unordered_inserts(self) -> None:
+        for key in ["m", "c", "x", "a", "c"]:
+            self.store.set(key, key.upper())
+        for key in ["a", "c", "m", "x"]:
+            self.assertEqual(self.store.get(key), key.upper())
+        self.assertIsNone(self.store.get("b"))
+
+    def test_batch_commits_on_exit(self) -> None:
+        with self.store.batch():
+            self.store.set("a", "1")
+            self.store.set("b", "2")
+            self.assertEqual(self.store.get("a"), "1")
+        new_store = KeyValueStore()
+        self.assertEqual(new_store.get("a"), "1")
+        self.assertEqual(new_store.get("b"), "2")
+
+    def test_batch_does_not_capture_other_threads(self) -> None:
+        if self.store.durability == "buffer":
+            self.skipTest("buffer durability stages every write")
+        with self.store.batch():
+            self.store.set("mine", "1")
+            other = threading.Thread(target=self.store.set, args=("theirs", "2"))
+            other.start()
+            other.join()
+            with open(DATA_FILE, "rb") as f:
+                self.assertEqual(f.read().rstrip(b"\0"), b"SET theirs 2\n")
+        with open(DATA_FILE, "rb") as f:
+            self.assertIn(b"SET mine 1\n", f.read())
+
+    def test_failed_batch_does_not_roll_back_other_threads(self) -> None:
+        if self.store.durability == "buffer":
+            self.skipTest("buffer durability defers the write past the batch")
+        entered, flushed = threading.Event(), threading.Event()
+
+        def other() -> None:
+            with self.store.batch():
+                self.store.set("ka", "1")
+                entered.set()
+                flushed.wait(10)
+        thread = threading.Thread(target=other)
+        thread.start()
+        entered.wait(10)
+
+        def fail(fd: int, iov: list) -> None:
+            raise OSError(28, "No space left on device")
+        writev_all = kvstore._writev_all
+        kvstore._writev_all = fail
+        try:
+            with self.assertLogs("kvstore", "ERROR"):
+                with self.assertRaises(KVError):
+                    with self.store.batch():
+                        self.store.set("kb", "1")
+                        self.store.set("kc", "1")
+        finally:
+            kvstore._writev_all = writev_all
+            flushed.set()
+            thread.join()
+        self.assertEqual(self.store.get("ka"), "1")
+        self.assertIsNone(self.store.get("kb"))
+        self.store.close()
+        self.store = KeyValueStore()
+        self.assertEqual(self.store.get("ka"), "1")
+        self.assertIsNone(self.store.get("kb"))
+
+    def test_failed_batch_leaves_index_unchanged(self) -> None:
+        if self.store.durability == "buffer":
+            self.skipTest("buffer durability defers the write past the batch")
+        self.store.set("a", "old")
+
+        def fail(fd: int, iov: list) -> None:
+            raise OSError(28, "No space left on device")
+        writev_all = kvstore._writev_all
+        kvstore._writev_all = fail
+        try:
+            with self.assertLogs("kvstore", "ERROR"):
+                with self.assertRaises(KVError):
+                    with self.store.batch():
+                        self.store.set("a", "new")
+                        self.store.set("b", "new")
+        finally:
+            kvstore._writev_all = writev_all
+        self.assertEqual(self.store.get("a"), "old")
+        self.assertIsNone(self.store.get("b"))
+        self.store.close()
+        self.store = KeyValueStore()
+        self.assertEqual(self.store.get("a"), "old")
+        self.assertIsNone(self.store.get("b"))
+
+    def test_context_manager_closes_store(self) -> None:
+        self.store.close()
+        with KeyValueStore() as store:
+            store.set("k", "v")
+        self.assertEqual(store._fd, -1)
+        self.store = KeyValueStore()
+        self.assertEqual(self.store.get("k"), "v")
+
+    def test_unsynced_set_is_durable_after_close(self) -> None:
+        self.store.set("fast", "1", sync=False)
+        self.assertEqual(self.store.get("fast"), "1")
+        self.store.close()
+        new_store = KeyValueStore()
+        self.assertEqual(new_store.get("fast"), "1")
+        new_store.close()
+
+    def test_group_window_is_synced_after_a_pause(self) -> None:
+        self.store.close()
+        self.store = KeyValueStore(durability="group")
+        self.store.set("k", "v")
+        self.assertGreater(self.store._unsynced_bytes, 0)
+        time.sleep(kvstore.GROUP_COMMIT_INTERVAL * 5)
+        self.assertEqual(self.store._unsynced_bytes, 0)
+
+    def test_buffer_durability_stages_writes_until_close(self) -> None:
+        self.store.close()
+        self.store = KeyValueStore(durability="buffer")
+        self.store.set("k", "v")
+        self.assertEqual(os.path.getsize(DATA_FILE), 0)
+        self.store.close()
+        with open(DATA_FILE, "rb") as f:
+            self.assertEqual(f.read(), b"SET k v\n")
+
+    def test_buffer_durability_keeps_records_after_failed_flush(self) -> None:
+        self.store.close()
+        self.store = KeyValueStore(durability="buffer")
+        self.store.set("k", "v")
+        fd = self.store._fd
+        # A read-only descriptor makes the staged write fail with EBADF.
+        self.store._fd = os.open(DATA_FILE, os.O_RDONLY)
+        try:
+            with self.assertLogs("kvstore", "ERROR"):
+                with self.assertRaises(KVError):
+                    self.store.flush_batch()
+            self.assertEqual(bytes(self.store._wbuf), b"SET k v\n")
+        finally:
+            os.close(self.store._fd)
+            self.store._fd = fd
+        self.assertEqual(self.store.get("k"), "v")
+        self.store.close()
+        self.store = KeyValueStore()
+        self.assertEqual(self.store.get("k"), "v")
+
+    def test_unknown_durability_mode(self) -> None:
+        with self.assertRaises(ValueError):
+            KeyValueStore(durability="fast")
+
+    def test_concurrent_sets_are_all_durable(self) -> None:
+        def writer(t: int) -> None:
+            for i in range(50):
+                self.store.set(f"t{t}-{i}", str(i))
+        threads = [threading.Thread(target=writer, args=(t,)) for t in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        new_store = KeyValueStore()
+        for t in range(4):
+            self.assertEqual(new_store.get(f"t{t}-49"), "49")
+        self.assertEqual(len(new_store.index), 200)
+
+    def test_compact_drops_superseded_records(self) -> None:
+        for i in range(10):
+            self.store.set("x", str(i))
+        self.store.set("y", "last")
+        self.store.compact()
+        with open(DATA_FILE, "r", encoding="utf-8") as f:
+            self.assertEqual(len(f.readlines()), 2)
+        self.store.set("z", "after")
+        new_store = KeyValueStore()
+        self.assertEqual(new_store.get("x"), "9")
+        self.assertEqual(new_store.get("y"), "last")
+        self.assertEqual(new_store.get("z"), "after")
+
+    def test_auto_compaction_keeps_latest_values(self) -> None:
+        for i in range(kvstore.COMPACT_MIN_RECORDS):
+            self.store.set(f"k{i % 10}", str(i))
+        self.assertLess(self.store._log_records, kvstore.COMPACT_MIN_RECORDS)
+        new_store = KeyValueStore()
+        last = kvstore.COMPACT_MIN_RECORDS - 1
+        self.assertEqual(new_store.get(f"k{last % 10}"), str(last))
+
+    def test_startup_compacts_overgrown_log(self) -> None:
+        self.store.close()
+        with open(DATA_FILE, "w", encoding="utf-8") as f:
+            for i in range(kvstore.COMPACT_MIN_RECORDS):
+                f.write(f"SET k{i % 10} {i}\n")
+        self.store = KeyValueStore()
+        self.assertEqual(self.store._log_records, 10)
+        with open(DATA_FILE, encoding="utf-8") as f:
+            self.assertEqual(len(f.readlines()), 10)
+        self.assertEqual(self.store.get("k9"),
+                         str(kvstore.COMPACT_MIN_RECORDS - 1))
+
+    def test_snapshot_then_tail_replay(self) -> None:
+        self.store.set("a", "1")
+        self.store.snapshot()
+        self.store.set("a", "2")
+        self.store.set("b", "3")
+        new_store = KeyValueStore()
+        self.assertEqual(new_store.get("a"), "2")
+        self.assertEqual(new_store.get("b"), "3")
+
+    def test_restart_from_snapshot_only(self) -> None:
+        self.store.set("course", "CSCE5350")
+        self.store.snapshot()
+        self.store.close()
+        self.assertTrue(os.path.exists(SNAP_FILE))
+        new_store = KeyValueStore()
+        self.assertEqual(new_store.get("course"), "CSCE5350")
+
+    def test_close_skips_snapshot_for_short_tail(self) -> None:
+        self.store.set("k", "v")
+        self.store.close()
+        self.assertFalse(os.path.exists(SNAP_FILE))
+
+    def test_stale_snapshot_is_ignored(self) -> None:
+        self.store.set("old", "value")
+        self.store.snapshot()
+        self.store.close()
+        os.remove(DATA_FILE)
+        with open(DATA_FILE, "w", encoding="utf-8") as f:
+            f.write("SET fresh start\nSET other data\n")
+        new_store = KeyValueStore()
+        self.assertIsNone(new_store.get("old"))
+        self.assertEqual(new_store.get("fresh"), "start")
+
+    def test_preallocated_log_replays_and_truncates(self) -> None:
+        self.store.close()
+        prealloc = kvstore.PREALLOC_BYTES
+        kvstore.PREALLOC_BYTES = 1 << 20
+        try:
+            self.store = KeyValueStore()
+            self.store.set("a", "1")
+            self.store.set("b", "2")
+            if not kvstore._preallocating():
+                self.skipTest("posix_fallocate not available")
+            self.assertGreaterEqual(os.path.getsize(DATA_FILE), 1 << 20)
+            # Reopen without close(), as after a crash: padding is ignored
+            # and new records go right after the old ones.
+            crashed = KeyValueStore()
+            self.assertEqual(crashed.get("b"), "2")
+            crashed.set("c", "3")
+            crashed.close()
+            os.close(self.store._fd)  # Superseded by the reopened store.
+            self.store._fd = -1
+            with open(DATA_FILE, "rb") as f:
+                self.assertEqual(f.read(), b"SET a 1\nSET b 2\nSET c 3\n")
+        finally:
+            kvstore.PREALLOC_BYTES = prealloc
+
+    def test_padding_is_trimmed_without_preallocation(self) -> None:
+        self.store.close()
+        with open(DATA_FILE, "wb") as f:
+            f.write(b"SET a 1\n" + b"\0" * 4096)
+        prealloc = kvstore.PREALLOC_BYTES
+        kvstore.PREALLOC_BYTES = 0
+        try:
+            self.store = KeyValueStore()
+            self.store.set("b", "2")
+            self.store.close()
+        finally:
+            kvstore.PREALLOC_BYTES = prealloc
+        with open(DATA_FILE, "rb") as f:
+            self.assertEqual(f.read(), b"SET a 1\nSET b 2\n")
+
+    def test_preallocation_reserves_next_window(self) -> None:
+        if not hasattr(os, "posix_fallocate"):
+            self.skipTest("posix_fallocate not available")
+        self.store.close()
+        prealloc = kvstore.PREALLOC_BYTES
+        kvstore.PREALLOC_BYTES = 4096
+        try:
+            self.store = KeyValueStore()
+            for i in range(100):
+                self.store.set(f"key{i}", "x" * 40)
+            end = os.lseek(self.store._fd, 0, os.SEEK_CUR)
+            self.assertGreater(end, 4096)
+            self.assertGreater(self.store._alloc_end, end)
+            self.assertEqual(os.path.getsize(DATA_FILE), self.store._alloc_end)
+            self.store.close()
+            self.assertEqual(os.path.getsize(DATA_FILE), end)
+        finally:
+            kvstore.PREALLOC_BYTES = prealloc
+
     def test_log_replay_skips_bad_lines(self) -> None:
         with open(DATA_FILE, "w", encoding="utf-8") as f:
             f.write("BADLINE without set\n")
@@ -72,22 +379,44 @@ class TestKeyValueStore(unittest.TestCase):
         new_store = KeyValueStore()
         self.assertEqual(new_store.get("good"), "test")
 
+    def test_log_replay_skips_undecodable_records(self) -> None:
+        with open(DATA_FILE, "wb") as f:
+            f.write(b"SET bad \xff\xfe\n")
+            f.write(b"SET good test\n")
+        with self.assertLogs("kvstore", "WARNING"):
+            new_store = KeyValueStore()
+        self.assertIsNone(new_store.get("bad"))
+        self.assertEqual(new_store.get("good"), "test")
+
+    def test_log_replay_keeps_last_decodable_value(self) -> None:
+        with open(DATA_FILE, "wb") as f:
+            f.write(b"SET k old\nSET k caf\xc3")
+        with self.assertLogs("kvstore", "WARNING"):
+            new_store = KeyValueStore()
+        self.assertEqual(new_store.get("k"), "old")
+        new_store.close()
+
 
 class TestParseCommand(unittest.TestCase):
 
     def test_parse_set(self) -> None:
-        cmd, args = _parse_command("SET name value")
-        self.assertEqual(cmd, "SET")
-        self.assertEqual(args, ["name", "value"])
+        cmd, args = _parse_command(b"SET name value")
+        self.assertEqual(cmd, b"SET")
+        self.assertEqual(args, [b"name", b"value"])
 
     def test_parse_get(self) -> None:
-        cmd, args = _parse_command("GET name")
-        self.assertEqual(cmd, "GET")
-        self.assertEqual(args, ["name"])
+        cmd, args = _parse_command(b"GET name")
+        self.assertEqual(cmd, b"GET")
+        self.assertEqual(args, [b"name"])
+
+    def test_parse_lowercase_verb(self) -> None:
+        cmd, args = _parse_command(b"get Name")
+        self.assertEqual(cmd, b"GET")
+        self.assertEqual(args, [b"Name"])
 
     def test_parse_empty(self) -> None:
-        cmd, args = _parse_command("   ")
-        self.assertEqual(cmd, "")
+        cmd, args = _parse_command(b"   ")
+        self.assertEqual(cmd, b"")
         self.assertEqual(args, [])
 
 
@@ -103,12 +432,145 @@ class TestErrorHandling(unittest.TestCase):
         finally:
             sys.stdout = sys.__stdout__
 
+    def test_bad_environment_settings_fall_back(self) -> None:
+        env = dict(os.environ, KVSTORE_GROUP_BYTES="lots", KVSTORE_GROUP_MS="",
+                   KVSTORE_DURABILITY="fast")
+        result = subprocess.run(
+            [sys.executable, "-c",
+             "import kvstore; print(kvstore.GROUP_COMMIT_BYTES, "
+             "kvstore.GROUP_COMMIT_INTERVAL, kvstore.DURABILITY)"],
+            cwd=os.path.dirname(os.path.abspath(__file__)), env=env,
+            capture_output=True, timeout=10,
+        )
+        self.assertEqual(result.returncode, 0)
+        self.assertEqual(result.stdout.split()[:2], [b"65536", b"0.01"])
+        self.assertEqual(result.stderr.count(b"Ignoring KVSTORE_"), 3)
+
+    def test_bad_log_level_falls_back(self) -> None:
+        script = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                              "kvstore.py")
+        with tempfile.TemporaryDirectory() as tmp:
+            result = subprocess.run(
+                [sys.executable, script], cwd=tmp,
+                env=dict(os.environ, KVSTORE_LOG="BASIC_FORMAT"),
+                input=b"SET k v\nGET k\nEXIT\n", capture_output=True,
+                timeout=10,
+            )
+            self.assertEqual(result.stdout, b"v\n")
+            with open(os.path.join(tmp, "kvstore.log"), encoding="utf-8") as f:
+                self.assertIn("Ignoring KVSTORE_LOG='BASIC_FORMAT'", f.read())
+
     def test_invalid_args_set(self) -> None:
-        cmd, args = _parse_command("SET onlykey")
-        self.assertEqual(cmd, "SET")
+        cmd, args = _parse_command(b"SET onlykey")
+        self.assertEqual(cmd, b"SET")
         self.assertEqual(len(args), 1)
 
 
+class TestRepl(unittest.TestCase):
+
+    SCRIPT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "kvstore.py")
+
+    def setUp(self) -> None:
+        self.tmp = tempfile.TemporaryDirectory()
+
+    def tearDown(self) -> None:
+        self.tmp.cleanup()
+
+    def _spawn(self) -> subprocess.Popen:
+        return subprocess.Popen(
+            [sys.executable, self.SCRIPT], cwd=self.tmp.name,
+            stdin=subprocess.PIPE, stdout=subprocess.PIPE,
+        )
+
+    def test_replies_each_command_before_next_input(self) -> None:
+        proc = self._spawn()
+        try:
+            proc.stdin.write(b"SET k v\nGET k\n")
+            proc.stdin.flush()
+            self.assertEqual(proc.stdout.readline(), b"v\n")
+            proc.stdin.write(b"GET missing\n")
+            proc.stdin.flush()
+            self.assertEqual(proc.stdout.readline(), b"NULL\n")
+            proc.stdin.write(b"EXIT\n")
+            proc.stdin.flush()
+            self.assertEqual(proc.wait(timeout=10), 0)
+        finally:
+            proc.kill()
+            proc.stdin.close()
+            proc.stdout.close()
+
+    def test_failed_chunk_commit_sends_no_stale_replies(self) -> None:
+        _remove_store_files()
+        store = KeyValueStore()
+        if store.durability == "buffer":
+            store.close()
+            self.skipTest("buffer durability defers the write past the chunk")
+        in_read, in_write = os.pipe()
+        out_read, out_write = os.pipe()
+        os.write(in_write, b"SET a 1\nGET a\n")
+        os.close(in_write)
+        fds = kvstore._STDIN_FD, kvstore._STDOUT_FD
+        kvstore._STDIN_FD, kvstore._STDOUT_FD = in_read, out_write
+        log_fd = store._fd
+        # A read-only descriptor makes every commit fail with EBADF.
+        store._fd = os.open(DATA_FILE, os.O_RDONLY)
+        try:
+            with self.assertLogs("kvstore", "ERROR"):
+                kvstore._serve(store)
+            reply = os.read(out_read, 4096)
+        finally:
+            kvstore._STDIN_FD, kvstore._STDOUT_FD = fds
+            os.close(store._fd)
+            store._fd = log_fd
+            store.close()
+            for fd in (in_read, out_read, out_write):
+                os.close(fd)
+            _remove_store_files()
+        self.assertEqual(
+            reply, b"ERR: write failed: [Errno 9] Bad file descriptor\nNULL\n")
+
+    def test_read_batches_joins_lines_split_across_reads(self) -> None:
+        read_fd, write_fd = os.pipe()
+        os.write(write_fd, b"SET k " + b"v" * 40 + b"\nGET k\nGET")
+        os.close(write_fd)
+        chunk = kvstore.READ_CHUNK
+        kvstore.READ_CHUNK = 16
+        try:
+            lines = [line for batch in kvstore._read_batches(read_fd)
+                     for line in batch]
+        finally:
+            kvstore.READ_CHUNK = chunk
+            os.close(read_fd)
+        self.assertEqual(lines, [b"SET k " + b"v" * 40, b"GET k", b"GET"])
+
+    def test_closed_stdout_raises_broken_pipe(self) -> None:
+        read_fd, write_fd = os.pipe()
+        os.close(read_fd)
+        stdout_fd = kvstore._STDOUT_FD
+        kvstore._STDOUT_FD = write_fd
+        try:
+            kvstore._write_line("v")
+            with self.assertRaises(BrokenPipeError):
+                kvstore._flush_output()
+            self.assertEqual(len(kvstore._OUT_BUF), 0)
+        finally:
+            kvstore._STDOUT_FD = stdout_fd
+            os.close(write_fd)
+
+    def test_persistence_across_processes(self) -> None:
+        first = subprocess.run(
+            [sys.executable, self.SCRIPT], cwd=self.tmp.name,
+            input=b"SET course CSCE5350\nEXIT\n", capture_output=True, timeout=10,
+        )
+        self.assertEqual(first.stdout, b"")
+        second = subprocess.run(
+            [sys.executable, self.SCRIPT], cwd=self.tmp.name,
+            input=b"GET course\nBOGUS\n", capture_output=True, timeout=10,
+        )
+        self.assertEqual(
+            second.stdout, b"CSCE5350\nERR: unknown command (use SET/GET/EXIT)\n")
+
+
 if __name__ == "__main__":
     unittest.main()
 